@@ -1,9 +1,20 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
 import urllib.parse
 import socketserver
 import os
 import random
+import sys
+import io
+import time
+import hmac
+import threading
+import cProfile
+import pstats
+import statistics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter, deque
+from contextlib import contextmanager
 from datetime import datetime
 
 # Try to import Gemini API modules, but allow the server to run without them
@@ -19,6 +30,64 @@ except ImportError:
 # Note: For a production server, you'd want per-user sessions or a database
 messages = []
 message_id = 1
+# Unique per process and bumped whenever the history is cleared, so waiting clients can
+# resync after a reset or a server restart
+history_version = int(time.time() * 1000)
+messages_changed = threading.Condition()  # Guards messages and wakes up long-poll clients
+chat_lock = threading.Lock()  # Serializes /chat requests and history resets
+LONG_POLL_TIMEOUT = 30  # Maximum seconds a GET /messages/wait request is held open
+
+def add_message(role, parts):
+    """Append a message to the history and wake up clients waiting for new messages."""
+    global message_id
+    with messages_changed:
+        message = {'id': message_id, 'role': role, 'parts': parts}
+        messages.append(message)
+        message_id += 1
+        messages_changed.notify_all()
+    return message
+
+def messages_after(after):
+    """Return the messages with an id greater than after (ids always increase)."""
+    start = len(messages)
+    while start > 0 and messages[start - 1]['id'] > after:
+        start -= 1
+    return messages[start:]
+
+# Profiling state for the admin endpoint (off until an admin starts a session)
+profiling = {
+    'active': False,     # True while a profiling session is running
+    'mode': None,        # 'deterministic' (cProfile) or 'sampling' (collapsed stacks)
+    'remaining': 0,      # Number of requests left to profile when no deadline is set
+    'deadline': None,    # time.monotonic() value at which profiling stops
+    'profiled': 0,       # Number of requests profiled in the current session
+    'stats': None,       # pstats.Stats aggregated across profiled requests
+    'stacks': Counter(), # Collapsed stack -> number of samples
+}
+profiling_lock = threading.Lock()
+recent_traces = deque(maxlen=50)  # Trace spans of the most recent requests
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples in sampling mode
+
+# Model routing rules, checked in order. A rule matches when all of its conditions do
+# ('max_prompt_chars', 'min_prompt_chars', 'tool_response'), and its 'models' are tried in order
+# of preference. Requests that match no rule use the default model from init_gemini.
+routing_rules = [
+    # Example: uncomment to send long prompts to the larger model
+    # {'min_prompt_chars': 1000, 'models': ['gemini-2.5-flash', 'gemini-2.5-flash-lite']},
+    # Example: uncomment to let the larger model write the answer from the function results
+    # {'tool_response': True, 'models': ['gemini-2.5-flash', 'gemini-2.5-flash-lite']},
+    # Use the default model, falling back to the larger one when it's slow
+    {'models': ['gemini-2.5-flash-lite', 'gemini-2.5-flash']},
+]
+model_latencies = {}  # Model name -> recent (timestamp, seconds) response times
+routing_lock = threading.Lock()
+LATENCY_SAMPLES = 100  # Number of recent response times kept per model
+LATENCY_WINDOW = 300  # Seconds a response time counts towards routing, so slow models get retried
+MIN_LATENCY_SAMPLES = 5  # Response times needed before a model's p95 is used
+UPSTREAM_WORKERS = 16  # Maximum number of Gemini API calls running in upstream_pool
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS)  # Runs hedged Gemini API calls
+# One slot per pool worker, so calls are only submitted when they can start right away
+upstream_slots = threading.BoundedSemaphore(UPSTREAM_WORKERS)
 
 def load_env():
     """Load environment variables from .env file."""
@@ -267,7 +336,9 @@ def init_gemini():
         tools = types.Tool(function_declarations=[weather_function, trivia_function, quiz_function]) # Add tools here
         return {
             'client': client,
-            'model': 'gemini-2.5-flash-lite',  # Consistent model name
+            'model': 'gemini-2.5-flash-lite',  # Default model when no routing rule matches
+            'latency_budget': float(os.environ.get('ROUTING_LATENCY_BUDGET', 10)),
+            'hedge': os.environ.get('HEDGE_REQUESTS', '').lower() in ('1', 'true', 'yes'),
             'config': types.GenerateContentConfig(
                 temperature=0.5,
                 tools=[tools],
@@ -281,6 +352,237 @@ def init_gemini():
         print(f"Warning: Failed to initialize Gemini API: {e}. Using mock replies.")
         return None
 
+class RequestTrace:
+    """Collects named timing spans (in milliseconds) for a single request."""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans = {}
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block and add it to the span with the given name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.spans[name] = round(self.spans.get(name, 0) + elapsed, 3)
+
+    def finish(self):
+        """Store the trace so it can be read from the admin profile endpoint."""
+        recent_traces.append({
+            'path': self.path,
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 3),
+            'spans': self.spans,
+        })
+
+def claim_profiling_slot():
+    """Return the profiling mode if the current request should be profiled, otherwise None."""
+    with profiling_lock:
+        if not profiling['active']:
+            return None
+        if profiling['deadline'] is not None:
+            if time.monotonic() >= profiling['deadline']:
+                profiling['active'] = False
+                return None
+        elif profiling['remaining'] <= 0:
+            # Not marked inactive here, as a slot can still be given back by release_profiling_slot()
+            return None
+        else:
+            profiling['remaining'] -= 1
+        profiling['profiled'] += 1
+        return profiling['mode']
+
+def release_profiling_slot():
+    """Give back a slot claimed by claim_profiling_slot() for a request that could not be profiled."""
+    with profiling_lock:
+        if not profiling['active']:
+            return
+        profiling['profiled'] = max(profiling['profiled'] - 1, 0)
+        if profiling['deadline'] is None:
+            profiling['remaining'] += 1
+
+def sample_stacks(thread_id, stop):
+    """Sample the stack of the given thread until stop is set and merge the collapsed stacks."""
+    samples = Counter()
+    while not stop.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            samples[';'.join(reversed(stack))] += 1
+    with profiling_lock:
+        profiling['stacks'].update(samples)
+
+def run_profiled(mode, func):
+    """Call func, profiling it with the given mode (None runs it unprofiled)."""
+    if mode == 'deterministic':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one cProfile profiler can be active at a time, so don't count this request
+            release_profiling_slot()
+            return func()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            with profiling_lock:
+                if profiling['stats'] is None:
+                    profiling['stats'] = pstats.Stats(profiler)
+                else:
+                    profiling['stats'].add(profiler)
+    elif mode == 'sampling':
+        stop = threading.Event()
+        sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop), daemon=True)
+        sampler.start()
+        try:
+            return func()
+        finally:
+            stop.set()
+            sampler.join()
+    return func()
+
+def profiling_status():
+    """Return a summary of the current profiling session."""
+    active = profiling['active']
+    remaining_seconds = None
+    if profiling['deadline'] is not None:
+        remaining_seconds = max(round(profiling['deadline'] - time.monotonic(), 3), 0) if active else 0
+        active = active and remaining_seconds > 0
+    else:
+        active = active and profiling['remaining'] > 0
+    return {
+        'active': active,
+        'mode': profiling['mode'],
+        'remaining_requests': profiling['remaining'] if profiling['deadline'] is None else None,
+        'remaining_seconds': remaining_seconds,
+        'profiled_requests': profiling['profiled'],
+    }
+
+def record_latency(model, seconds):
+    """Store the response time of a Gemini API call for latency-aware routing."""
+    with routing_lock:
+        model_latencies.setdefault(model, deque(maxlen=LATENCY_SAMPLES)).append((time.monotonic(), seconds))
+
+def recent_latencies(model):
+    """Return the response times of a model recorded within the last LATENCY_WINDOW seconds."""
+    cutoff = time.monotonic() - LATENCY_WINDOW
+    with routing_lock:
+        return [seconds for timestamp, seconds in model_latencies.get(model, ()) if timestamp >= cutoff]
+
+def latency_p95(model):
+    """Return the p95 response time of a model, or None if it has too few recent samples."""
+    samples = recent_latencies(model)
+    if len(samples) < MIN_LATENCY_SAMPLES:
+        return None
+    return statistics.quantiles(samples, n=20)[-1]
+
+def model_latency_summary():
+    """Return the recent p50 and p95 response times (in milliseconds) of each model."""
+    with routing_lock:
+        models = list(model_latencies)
+    summary = {}
+    for model in models:
+        samples = recent_latencies(model)
+        if not samples:
+            continue
+        p95 = statistics.quantiles(samples, n=20)[-1] if len(samples) >= MIN_LATENCY_SAMPLES else None
+        summary[model] = {
+            'count': len(samples),
+            'p50_ms': round(statistics.median(samples) * 1000, 3),
+            'p95_ms': round(p95 * 1000, 3) if p95 is not None else None,
+        }
+    return summary
+
+def prompt_length(contents):
+    """Return the number of characters in the latest user message."""
+    for content in reversed(contents):
+        if content['role'] == 'user':
+            return sum(len(part.get('text', '')) for part in content['parts'])
+    return 0
+
+def is_tool_response(contents):
+    """Return True if the request sends function results back to the model."""
+    return bool(contents) and any('functionResponse' in part for part in contents[-1]['parts'])
+
+def route_models(gemini, contents):
+    """Return the candidate models for a request, the one to call first at the front."""
+    length = prompt_length(contents)
+    tool_response = is_tool_response(contents)
+    models = [gemini['model']]
+    for rule in routing_rules:
+        if 'max_prompt_chars' in rule and length > rule['max_prompt_chars']:
+            continue
+        if 'min_prompt_chars' in rule and length < rule['min_prompt_chars']:
+            continue
+        if 'tool_response' in rule and tool_response != rule['tool_response']:
+            continue
+        models = list(rule['models'])
+        break
+
+    # Skip the preferred model while it is slower than the latency budget. Models without
+    # enough recent samples count as fast, so a demoted model is tried again once its slow
+    # response times are older than LATENCY_WINDOW.
+    p95 = latency_p95(models[0])
+    if p95 is not None and p95 > gemini['latency_budget']:
+        models.sort(key=lambda model: latency_p95(model) or 0)
+    return models
+
+def call_model(gemini, model, contents):
+    """Call the Gemini API with the given model and record its response time."""
+    start = time.monotonic()
+    response = gemini['client'].models.generate_content(
+        model=model,
+        contents=contents,
+        config=gemini['config']
+    )
+    record_latency(model, time.monotonic() - start)
+    return response
+
+def call_model_in_pool(gemini, model, contents):
+    """Call the model from upstream_pool and free the slot taken for the call."""
+    try:
+        return call_model(gemini, model, contents)
+    finally:
+        upstream_slots.release()
+
+def generate_content(gemini, contents):
+    """
+    Send contents to the model picked by the routing rules.
+    If hedging is enabled and the model takes longer than its p95, the request is also sent
+    to the next candidate model and whichever answers first is used. Nothing is hedged while
+    upstream_pool is full, so hedging doesn't add load when the server is already busy.
+    """
+    models = route_models(gemini, contents)
+    deadline = latency_p95(models[0]) if gemini['hedge'] else None
+    if deadline is None or not upstream_slots.acquire(blocking=False):
+        return call_model(gemini, models[0], contents)
+
+    # A slot guarantees a free worker, so the deadline only counts time the call is running
+    first = upstream_pool.submit(call_model_in_pool, gemini, models[0], contents)
+    done, _ = wait([first], timeout=deadline)
+    if done or not upstream_slots.acquire(blocking=False):
+        return first.result()
+
+    hedge_model = models[1] if len(models) > 1 else models[0]
+    print(f"Hedging: {models[0]} took longer than {deadline:.2f}s, also asking {hedge_model}")
+    pending = {first, upstream_pool.submit(call_model_in_pool, gemini, hedge_model, contents)}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+        if not pending:
+            # Both requests failed, so raise the error of the last one
+            return done.pop().result()
+
 # Load environment variables and initialize Gemini
 load_env()  # Load .env before initializing Gemini as it contains the Gemini API key
 gemini = init_gemini()
@@ -307,84 +609,234 @@ class SimpleRESTServer(BaseHTTPRequestHandler):
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             self.wfile.write(json.dumps(messages).encode())
+        elif path == '/messages/wait':
+            self.wait_for_messages(urllib.parse.parse_qs(parsed_path.query))
+        elif path == '/admin/profile':
+            if self.check_admin():
+                self.send_profile(urllib.parse.parse_qs(parsed_path.query))
         else:
             self.send_error(404, 'Not found')
 
     def do_POST(self):
         """Handle POST requests to send a user message and get a chatbot response."""
         if self.path == '/chat':
-            global message_id
+            self.trace = RequestTrace(self.path)
+            try:
+                run_profiled(claim_profiling_slot(), self.handle_chat)
+            finally:
+                # Keep the trace of failed requests too
+                self.trace.finish()
+        elif self.path == '/admin/profile':
+            if self.check_admin():
+                self.start_profiling()
+        else:
+            self.send_error(404, 'Not found')
+
+    def handle_chat(self):
+        """Store the user message, generate a chatbot response and send it back."""
+        with self.trace.span('json_parsing'):
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
             try:
                 data = json.loads(post_data.decode())
-                if 'text' not in data:
-                    self.send_error(400, 'Missing "text" field in JSON')
-                    return
-                if not isinstance(data['text'], str) or not data['text'].strip():
-                    self.send_error(400, 'Text must be a non-empty string')
-                    return
-
-                print(f"User message: {data['text']}")
-
-                # Store user message
-                user_message = {'id': message_id, 'role': 'user', 'parts': [{'text': data['text']}]}
-                messages.append(user_message)
-                message_id += 1
-
-                # Generate a response
-                if gemini:
-                    try:
-                        # Prepare message history for Gemini (exclude IDs)
-                        contents = [{k: v for k, v in d.items() if k != 'id'} for d in messages]
-                        response = gemini['client'].models.generate_content(
-                            model=gemini['model'],
-                            contents=contents,
-                            config=gemini['config']
-                        )
-                        
-                        # Call the gemini response function to process the response
-                        model_text = self.process_gemini_response(response, message_id, messages, gemini, call_count=0)
-
-                    except Exception as e:
-                        print(f"Warning: Gemini API call failed: {e}. Using mock reply.")
-                        model_text = self.get_mock_reply(data['text'])
-                else:
-                    # Use mock reply if Gemini is unavailable
-                    model_text = self.get_mock_reply(data['text'])
-
-                # Store model response
-                model_reply = {'id': message_id, 'role': 'model', 'parts': [{'text': model_text}]}
-                messages.append(model_reply)
-                message_id += 1
-
-                # Send response back to client
-                self.send_response(201)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(model_reply).encode())
-
             except json.JSONDecodeError:
                 self.send_error(400, 'Invalid JSON format')
-        else:
-            self.send_error(404, 'Not found')
+                return
+        if 'text' not in data:
+            self.send_error(400, 'Missing "text" field in JSON')
+            return
+        if not isinstance(data['text'], str) or not data['text'].strip():
+            self.send_error(400, 'Text must be a non-empty string')
+            return
+
+        print(f"User message: {data['text']}")
+
+        # Handle one chat at a time so each reply is generated from a consistent history
+        with self.trace.span('chat_lock_wait'):
+            chat_lock.acquire()
+        try:
+            # Store user message
+            add_message('user', [{'text': data['text']}])
+
+            # Generate a response
+            if gemini:
+                try:
+                    # Prepare message history for Gemini (exclude IDs)
+                    with self.trace.span('history_preparation'):
+                        contents = [{k: v for k, v in d.items() if k != 'id'} for d in messages]
+                    with self.trace.span('upstream_wait'):
+                        response = generate_content(gemini, contents)
+                
+                    # Call the gemini response function to process the response
+                    model_text = self.process_gemini_response(response, messages, gemini, call_count=0)
+
+                except Exception as e:
+                    print(f"Warning: Gemini API call failed: {e}. Using mock reply.")
+                    model_text = self.get_mock_reply(data['text'])
+            else:
+                # Use mock reply if Gemini is unavailable
+                model_text = self.get_mock_reply(data['text'])
+
+            # Store model response
+            model_reply = add_message('model', [{'text': model_text}])
+        finally:
+            chat_lock.release()
+
+        # Send response back to client
+        with self.trace.span('response_write'):
+            self.send_response(201)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(model_reply).encode())
 
     def do_DELETE(self):
         """Handle DELETE requests to clear the conversation history."""
         if self.path == '/messages':
-            global messages, message_id
-            messages = []  # Clear all messages
-            message_id = 1  # Reset message ID
+            global messages, message_id, history_version
+            with chat_lock, messages_changed:
+                messages = []  # Clear all messages
+                message_id = 1  # Reset message ID
+                history_version += 1
+                messages_changed.notify_all()
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             self.wfile.write(json.dumps({'message': 'Chat history cleared'}).encode())
+        elif self.path == '/admin/profile':
+            if self.check_admin():
+                with profiling_lock:
+                    profiling['active'] = False
+                    status = profiling_status()
+                self.send_json(200, status)
         else:
             self.send_error(404, 'Not found')
+
+    def wait_for_messages(self, query):
+        """Hold the request until there are messages newer than ?after=<id>, then send only those."""
+        try:
+            after = int(query.get('after', ['0'])[0])
+            timeout = float(query.get('timeout', [LONG_POLL_TIMEOUT])[0])
+            history = int(query['history'][0]) if 'history' in query else None
+        except ValueError:
+            self.send_error(400, '"after", "history" and "timeout" must be numbers')
+            return
+        if not 0 <= timeout:
+            self.send_error(400, 'Timeout must be a non-negative number')
+            return
+        deadline = time.monotonic() + min(timeout, LONG_POLL_TIMEOUT)
+
+        with messages_changed:
+            while True:
+                # A different history version means the chat was cleared, so send everything again
+                reset = history is not None and history != history_version
+                new_messages = list(messages) if reset else messages_after(after)
+                remaining = deadline - time.monotonic()
+                if reset or new_messages or remaining <= 0:
+                    break
+                messages_changed.wait(remaining)
+            result = {'messages': new_messages, 'history': history_version, 'reset': reset}
+        self.send_json(200, result)
+
+    def check_admin(self):
+        """Check the X-Admin-Token header against ADMIN_TOKEN, sending an error if it does not match."""
+        admin_token = os.environ.get('ADMIN_TOKEN')
+        if not admin_token:
+            self.send_error(403, 'Admin endpoints are disabled. Set ADMIN_TOKEN in the .env file.')
+            return False
+        request_token = self.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(request_token.encode(), admin_token.encode()):
+            self.send_error(401, 'Invalid admin token')
+            return False
+        return True
+
+    def start_profiling(self):
+        """Start a profiling session for the next N requests or T seconds."""
+        content_length = int(self.headers.get('Content-Length') or 0)
+        try:
+            data = json.loads(self.rfile.read(content_length).decode() or '{}')
+        except json.JSONDecodeError:
+            self.send_error(400, 'Invalid JSON format')
+            return
+        if not isinstance(data, dict):
+            self.send_error(400, 'Expected a JSON object')
+            return
+
+        mode = data.get('mode', 'deterministic')
+        if mode not in ('deterministic', 'sampling'):
+            self.send_error(400, 'Mode must be "deterministic" or "sampling"')
+            return
+        requests = data.get('requests')
+        seconds = data.get('seconds')
+        if requests is not None and seconds is not None:
+            self.send_error(400, 'Set either "requests" or "seconds", not both')
+            return
+        if seconds is not None:
+            if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or not seconds > 0:
+                self.send_error(400, '"seconds" must be a positive number')
+                return
+        else:
+            if requests is None:
+                requests = 10  # Default to profiling the next 10 requests
+            if isinstance(requests, bool) or not isinstance(requests, int) or requests <= 0:
+                self.send_error(400, '"requests" must be a positive integer')
+                return
+
+        with profiling_lock:
+            profiling['active'] = True
+            profiling['mode'] = mode
+            profiling['remaining'] = requests if seconds is None else 0
+            profiling['deadline'] = time.monotonic() + seconds if seconds is not None else None
+            profiling['profiled'] = 0
+            profiling['stats'] = None
+            profiling['stacks'] = Counter()
+            status = profiling_status()
+        self.send_json(200, status)
+
+    def send_profile(self, query):
+        """Send the aggregated profile (pstats text or collapsed stacks) and recent trace spans."""
+        sort = query.get('sort', ['cumulative'])[0]
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            self.send_error(400, f'Unknown sort key: {sort}')
+            return
+        try:
+            limit = int(query.get('limit', ['30'])[0])
+        except ValueError:
+            self.send_error(400, 'Limit must be an integer')
+            return
+
+        # Copy the profile under the lock and format it afterwards, so /chat requests
+        # waiting in claim_profiling_slot() are not held up by a large profile
+        stacks = stats = None
+        with profiling_lock:
+            result = profiling_status()
+            if profiling['mode'] == 'sampling':
+                stacks = Counter(profiling['stacks'])
+            elif profiling['stats'] is not None:
+                stats = pstats.Stats()
+                stats.add(profiling['stats'])
+            result['traces'] = list(recent_traces)
+
+        if stacks is not None:
+            # One "stack count" line per stack, ready for flamegraph.pl or speedscope
+            result['collapsed'] = '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+        elif stats is not None:
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats(sort).print_stats(limit)
+            result['pstats'] = stream.getvalue()
+        result['models'] = model_latency_summary()
+        self.send_json(200, result)
+
+    def send_json(self, code, data):
+        """Send a JSON response with the given status code."""
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode())
     
     # Process Gemini response to handle function calling.
     # It can process parallel function calls and subsequent function calls until only text is received.
-    def process_gemini_response(self, response, message_id, messages, gemini, call_count=0):
+    def process_gemini_response(self, response, messages, gemini, call_count=0):
         """
         Processes a Gemini API response and handles function calls or text replies.
         Includes a guard to prevent excessive function calls.
@@ -407,48 +859,34 @@ class SimpleRESTServer(BaseHTTPRequestHandler):
                     print(f"Arguments: {function_call.args}")
 
                     # ... (your existing code to add tool_call to messages)
-                    tool_call = {
-                        'id': message_id, 
-                        'role': 'model', 
-                        'parts': [{
-                            'functionCall': {
-                                'name': function_call.name,
-                                'args': function_call.args
-                            }
-                        }]
-                    }
-                    messages.append(tool_call)
-                    message_id += 1
-
-                    result = run_api_tool(function_call.name, function_call.args)
+                    add_message('model', [{
+                        'functionCall': {
+                            'name': function_call.name,
+                            'args': function_call.args
+                        }
+                    }])
+
+                    with self.trace.span('tool_execution'):
+                        result = run_api_tool(function_call.name, function_call.args)
 
                     # ... (your existing code to add tool_response to messages)
-                    tool_response = {
-                        'id': message_id, 
-                        'role': 'model', 
-                        'parts': [{
-                            'functionResponse': {
-                                'name': function_call.name,
-                                'response': result
-                            }
-                        }]
-                    }
+                    tool_response = add_message('model', [{
+                        'functionResponse': {
+                            'name': function_call.name,
+                            'response': result
+                        }
+                    }])
 
                     print(f"tool-response: {tool_response}")
 
-                    messages.append(tool_response)
-                    message_id += 1
-
                     # Now, send everything back to Gemini again
-                    contents = [{k: v for k, v in d.items() if k != 'id'} for d in messages]
-                    next_response = gemini['client'].models.generate_content(
-                        model=gemini['model'],
-                        contents=contents,
-                        config=gemini['config']
-                    )
+                    with self.trace.span('history_preparation'):
+                        contents = [{k: v for k, v in d.items() if k != 'id'} for d in messages]
+                    with self.trace.span('upstream_wait'):
+                        next_response = generate_content(gemini, contents)
 
                     # Increment the call counter for the next recursive call
-                    return self.process_gemini_response(next_response, message_id, messages, gemini, call_count + 1)
+                    return self.process_gemini_response(next_response, messages, gemini, call_count + 1)
                 
                 else:
                     # Handle text-only replies
@@ -482,7 +920,7 @@ class SimpleRESTServer(BaseHTTPRequestHandler):
         # Fallback to a generic response
         return random.choice(['I see', 'Okay', 'Could you tell me more?', 'Interesting', 'Thanks for sharing'])
 
-def run(server_class=HTTPServer, handler_class=SimpleRESTServer, port=8000):
+def run(server_class=ThreadingHTTPServer, handler_class=SimpleRESTServer, port=8000):
     """Start the HTTP server."""
     # Get port from environment variable, fallback to default
     port = int(os.environ.get('SERVER_PORT', port))